@@ -15,6 +15,7 @@ import re
 import stat
 import logging
 import logging.handlers
+from collections import OrderedDict
 
 try:
     import fuse
@@ -69,6 +70,19 @@ fuse.fuse_python_api = (0, 2)
 
 fuse.feature_assert('stateful_files', 'has_init')
 
+# estimated memory held for an open file within an archive, on top of the
+# shared RarFile object, and for an open normal file, ie read buffers
+RAR_HANDLE_SIZE = 64 * 1024
+FILE_HANDLE_SIZE = 8 * 1024
+
+# default mem_limit and the smallest one we accept, anything smaller would not
+# fit the index of a single archive of any size
+DEFAULT_MEM_LIMIT = '64M'
+MIN_MEM_LIMIT = 1024 * 1024
+
+# prefix of the extended attributes on the root with memory governor stats
+STATS_XATTR_PREFIX = 'user.pyarrfs.'
+
 
 def isRarFilePath(path):
     if re.match(r'.*\.rar$', path, re.IGNORECASE):
@@ -90,6 +104,196 @@ def rarDirSplit(path):
     return False, False
 
 
+def parseSize(size):
+    """ Parse a human readable size, like 512M or 2G, into a number of bytes
+    """
+    m = re.match(r'^\s*(\d+)\s*([kmgt]?)b?\s*$', str(size), re.IGNORECASE)
+    if m is None:
+        raise ValueError("invalid size: " + str(size))
+    exp = ' kmgt'.index(m.group(2).lower() or ' ')
+    return int(m.group(1)) * 1024 ** exp
+
+
+def objSize(obj):
+    """ Approximate the memory held by an object and its instance dict
+    """
+    size = sys.getsizeof(obj)
+    d = getattr(obj, '__dict__', None)
+    if d is not None:
+        size += sys.getsizeof(d)
+        for v in d.itervalues():
+            size += sys.getsizeof(v)
+    return size
+
+
+
+class MemoryGovernor(object):
+    """ Accounting of the estimated memory held by PyarrFS
+
+        State is charged under a key with a callback to drop it. When over the
+        limit, the least recently used entries are evicted through their
+        callbacks. Entries without a callback, like open files, are pinned and
+        never evicted. A limit of None means no limit.
+    """
+    def __init__(self, limit = None):
+        self.limit = limit
+        self.usage = 0
+        self.evictions = 0
+        self.entries = OrderedDict()
+
+
+    def charge(self, key, size, evict = None):
+        """ Register, or update, the size of the state held under key and
+            mark it as most recently used. Without evict, the entry is pinned.
+        """
+        old = self.entries.pop(key, None)
+        if old is not None:
+            self.usage -= old[0]
+        self.entries[key] = (size, evict)
+        self.usage += size
+        self.enforce(key)
+
+
+    def touch(self, key):
+        """ Mark key as most recently used
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.entries[key] = entry
+
+
+    def release(self, key):
+        """ Forget about key, without calling its evict callback
+        """
+        entry = self.entries.pop(key, None)
+        if entry is not None:
+            self.usage -= entry[0]
+
+
+    def enforce(self, keep = None):
+        """ Evict least recently used entries until we are within our limit
+
+            The entry for keep is never evicted, it is typically what we just
+            charged for and is about to be used.
+        """
+        if self.limit is None:
+            return
+        for key in list(self.entries):
+            if self.usage <= self.limit:
+                break
+            (size, evict) = self.entries[key]
+            if key == keep or evict is None:
+                continue
+            del self.entries[key]
+            self.usage -= size
+            self.evictions += 1
+            logger.debug("governor: evicting " + str(key) + " (" + str(size) + " bytes)")
+            evict()
+
+
+    def stats(self):
+        """ Returns a dict with current usage, limit and number of evictions
+        """
+        pinned = [ e[0] for e in self.entries.itervalues() if e[1] is None ]
+        return {
+            'usage': self.usage,
+            'limit': self.limit or 0,
+            'entries': len(self.entries),
+            'pinned': sum(pinned),
+            'evictions': self.evictions
+        }
+
+
+
+class RarMember(object):
+    """ Compact record of the few attributes we need from a RarInfo object
+    """
+    __slots__ = ('file_size', 'date_time', 'compress_type')
+
+    def __init__(self, rfi):
+        self.file_size = rfi.file_size
+        self.date_time = tuple(rfi.date_time)
+        self.compress_type = rfi.compress_type
+
+
+
+class RarIndex(object):
+    """ Parsed listing of a RAR archive
+
+        Rather than keeping the RarFile object, with one full RarInfo object
+        per member, around we keep a RarMember per member. The mtime and size
+        of the archive are recorded so we can tell when it has changed.
+    """
+    __slots__ = ('mtime', 'size', 'names', 'members', 'nbytes')
+
+    def __init__(self, infolist, st):
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.names = []
+        self.members = {}
+        for rfi in infolist:
+            self.names.append(rfi.filename)
+            self.members[rfi.filename] = RarMember(rfi)
+
+        self.nbytes = sys.getsizeof(self) + sys.getsizeof(self.names) + sys.getsizeof(self.members)
+        for name, member in self.members.iteritems():
+            self.nbytes += sys.getsizeof(name) + sys.getsizeof(member) + sys.getsizeof(member.date_time)
+
+
+    def valid(self, st):
+        """ Returns whether the archive is unchanged since we parsed it
+        """
+        return self.mtime == st.st_mtime and self.size == st.st_size
+
+
+    def getMember(self, name):
+        """ Returns the RarMember for name, or None
+
+            Like rarfile's getinfo() we accept both / and \\ as separator.
+        """
+        if rarfile.PATH_SEP == '/':
+            name2 = name.replace('\\', '/')
+        else:
+            name2 = name.replace('/', '\\')
+        rfi = self.members.get(name)
+        if rfi is None:
+            rfi = self.members.get(name2)
+        return rfi
+
+
+
+class SharedRarFile(object):
+    """ A RarFile shared by all files open within the same archive
+
+        Opening a file within an archive needs the full RarFile, so one is
+        kept per archive for as long as any file within it is open and charged
+        to the memory governor once, pinned, with itself as key.
+    """
+    __slots__ = ('rf', 'mtime', 'size', 'refs')
+
+    def __init__(self, path, st):
+        self.mtime = st.st_mtime
+        self.size = st.st_size
+        self.refs = 0
+        self.rf = rarfile.RarFile(path, 'r', None, None, False)
+
+
+    def nbytes(self):
+        """ Returns the estimated size of the RarFile and its RarInfo objects
+        """
+        size = objSize(self.rf)
+        for rfi in self.rf.infolist():
+            size += objSize(rfi)
+        return size
+
+
+    def valid(self, st):
+        """ Returns whether the archive is unchanged since we parsed it
+        """
+        return self.mtime == st.st_mtime and self.size == st.st_size
+
+
+
 class Pyarr(fuse.Fuse):
     def __init__(self, *args, **kw):
         logger.info("init!")
@@ -101,6 +305,10 @@ class Pyarr(fuse.Fuse):
         self.pydebug = False
         self.foreground = False
         self.root = '/'
+        self.mem_limit = DEFAULT_MEM_LIMIT
+        self.governor = MemoryGovernor(parseSize(DEFAULT_MEM_LIMIT))
+        self.archives = {}
+        self.rarfiles = {}
 
 
 
@@ -111,6 +319,69 @@ class Pyarr(fuse.Fuse):
 
 
 
+    def rarIndex(self, rar_file):
+        """ Returns the RarIndex for the archive at rar_file
+
+            Indexes are cached and accounted for by the memory governor, which
+            may evict them, in which case we just parse the archive again.
+        """
+        key = ('archive', rar_file)
+        try:
+            st = os.stat('.' + rar_file)
+        except OSError:
+            # archive is gone, so should its index be
+            self.archives.pop(rar_file, None)
+            self.governor.release(key)
+            raise
+        ri = self.archives.get(rar_file)
+        if ri is not None and ri.valid(st):
+            self.governor.touch(key)
+            return ri
+
+        # reuse the RarFile of open files in the archive rather than parsing
+        # the archive once more
+        srf = self.rarfiles.get(rar_file)
+        if srf is not None and srf.valid(st):
+            rf = srf.rf
+        else:
+            rf = rarfile.RarFile('.' + rar_file, 'r', None, None, False)
+        ri = RarIndex(rf.infolist(), st)
+        self.archives[rar_file] = ri
+        self.governor.charge(key, ri.nbytes, lambda: self.archives.pop(rar_file, None))
+        return ri
+
+
+
+    def openRarFile(self, rar_file):
+        """ Returns the SharedRarFile for rar_file, with a reference taken
+
+            Every call must be paired with a call to closeRarFile().
+        """
+        st = os.stat('.' + rar_file)
+        srf = self.rarfiles.get(rar_file)
+        if srf is None or not srf.valid(st):
+            # files already open in a changed archive keep their old
+            # SharedRarFile until they are closed
+            srf = SharedRarFile('.' + rar_file, st)
+            self.rarfiles[rar_file] = srf
+            self.governor.charge(srf, srf.nbytes())
+        srf.refs += 1
+        return srf
+
+
+
+    def closeRarFile(self, rar_file, srf):
+        """ Drop a reference to srf, freeing it with the last reference
+        """
+        srf.refs -= 1
+        if srf.refs > 0:
+            return
+        self.governor.release(srf)
+        if self.rarfiles.get(rar_file) is srf:
+            del self.rarfiles[rar_file]
+
+
+
     def access(self, path, mode):
         """Returns whether a user has access to performing certain operations
         """
@@ -148,10 +419,9 @@ class Pyarr(fuse.Fuse):
             # if we run with the no_compressed option and files in a rar file
             # are compressed, we just present it as a ordinary directory
             if self.no_compressed:
-                rf = rarfile.RarFile('.' + path)
-                for n in rf.namelist():
-                    inf = rf.getinfo(n)
-                    if self.no_compressed and int(chr(inf.compress_type)) > 0:
+                ri = self.rarIndex(path)
+                for inf in ri.members.itervalues():
+                    if int(chr(inf.compress_type)) > 0:
                         return os.lstat('.' + path)
 
             original_stat = os.lstat('.' + path)
@@ -175,10 +445,8 @@ class Pyarr(fuse.Fuse):
             (rar_file, rar_path) = rarDirSplit(path)
 
             original_stat = os.lstat('.' + rar_file)
-            rf = rarfile.RarFile('.' + rar_file, 'r', None, None, False)
-            try:
-                rfi = rf.getinfo(rar_path)
-            except:
+            rfi = self.rarIndex(rar_file).getMember(rar_path)
+            if rfi is None:
                 # FIXME: add DEBUG log entry
                 return -errno.ENOENT
 
@@ -217,6 +485,20 @@ class Pyarr(fuse.Fuse):
         rather naive but seems to work for facl (tested by getfacl).
         """
         logger.info("getxattr -- path:{} xattr:{} foo:{}".format(path, name, foo))
+        # memory governor statistics are exposed as xattrs on the root, ie
+        # getfattr -n user.pyarrfs.usage /mnt/point
+        # the names are reserved by PyarrFS and not passed through anywhere
+        if name.startswith(STATS_XATTR_PREFIX):
+            if path != '/':
+                return -errno.ENODATA
+            stats = self.statsXattrs()
+            if name not in stats:
+                return -errno.ENODATA
+            val = stats[name]
+            if foo == 0:
+                return len(val)
+            return val
+
         if isRarDirPath(path):    # is inside a rar file
             logging.debug("getxattr: we need to check inside rar archive for path " + str(path))
             (rar_file, rar_path) = rarDirSplit(path)
@@ -232,6 +514,35 @@ class Pyarr(fuse.Fuse):
 
 
 
+    def listxattr(self, path, size):
+        """List extended attributes, passed through like getxattr with the
+        addition of the memory governor statistics on the root
+        """
+        logger.info("listxattr -- path:{} size:{}".format(path, size))
+        if isRarDirPath(path):    # is inside a rar file
+            (rar_file, rar_path) = rarDirSplit(path)
+            path = rar_file
+
+        names = [ n for n in xattr.xattr('.' + path).list() if not n.startswith(STATS_XATTR_PREFIX) ]
+        if path == '/':
+            names.extend(sorted(self.statsXattrs()))
+
+        if size == 0:
+            # size of the NUL separated list of names
+            return len("".join(names)) + len(names)
+        return names
+
+
+
+    def statsXattrs(self):
+        """ Returns the memory governor statistics as a dict of xattr names
+            and their values
+        """
+        stats = self.governor.stats()
+        return dict((STATS_XATTR_PREFIX + k, str(v)) for k, v in stats.iteritems())
+
+
+
     def readdir(self, path, offset):
         """ readdir - return directory listing
         """
@@ -240,8 +551,7 @@ class Pyarr(fuse.Fuse):
 
         if isRarFilePath(path):
             logger.debug("readdir: on rar archive, using rarfile")
-            rf = rarfile.RarFile('.' + path, 'r', None, None, False)
-            for e in rf.namelist():
+            for e in self.rarIndex(path).names:
                 dirent.append(str(e))
         else:
             logger.debug("readdir: normal dir, using os.listdir()")
@@ -290,7 +600,13 @@ class Pyarr(fuse.Fuse):
 
             This class is used both for non-rar files as well as rar files and
             thus needs to check what kind of file we're dealing with.
+
+            The buffers of the open file are charged to the memory governor,
+            pinned for as long as the file is open. Files within the same
+            archive share one SharedRarFile, see Pyarr.openRarFile().
         """
+        server = None
+
         def __init__(self, path, flags, *mode):
             # Enabling direct_io disables the kernels page cache.
             # Since the content of our RAR files should be pretty stable, we do
@@ -311,12 +627,21 @@ class Pyarr(fuse.Fuse):
             # That's not the case with PyarrFS so we enable it.
             self.keep_cache = True
 
+            self.rar_file = None
+            self.srf = None
             if isRarDirPath(path):
-                (rar_file, rar_path) = rarDirSplit(path)
-                self.rf = rarfile.RarFile('.' + rar_file, 'r', None, None, False)
-                self.file = self.rf.open(rar_path)
+                (self.rar_file, rar_path) = rarDirSplit(path)
+                self.srf = self.server.openRarFile(self.rar_file)
+                try:
+                    self.file = self.srf.rf.open(rar_path)
+                except:
+                    self.server.closeRarFile(self.rar_file, self.srf)
+                    raise
+                size = RAR_HANDLE_SIZE
             else:
                 self.file = open('.' + path)
+                size = FILE_HANDLE_SIZE
+            self.server.governor.charge(self, size)
 
 
         def read(self, length, offset):
@@ -330,10 +655,14 @@ class Pyarr(fuse.Fuse):
             """ release, or close, a file
             """
             self.file.close()
+            self.server.governor.release(self)
+            if self.srf is not None:
+                self.server.closeRarFile(self.rar_file, self.srf)
 
 
 
     def main(self, *a, **kw):
+        self.PyarrFile.server = self
         self.file_class = self.PyarrFile
         return fuse.Fuse.main(self, *a, **kw)
 
@@ -359,8 +688,19 @@ PyarrFS mirror the filesystem tree from some point on, allowing RAR archives to
     server.parser.add_option('-r', '--root', dest='root', metavar="PATH", default=server.root, help="mirror filesystem from under PATH [default: %default]")
     server.parser.add_option('-n', '--no-compressed', action='store_true', dest='no_compressed', default=False, help="Disable compressed files")
     server.parser.add_option('-D', '--pydebug', action='store_true', dest='pydebug', default=False, help="enable debug for just PyarrFS (not FUSE) (implies -f)")
+    server.parser.add_option(mountopt='mem_limit', metavar="SIZE", default=server.mem_limit, help="approximate memory budget for archive state, like 512M [default: %default]")
     server.parse(values=server, errex=1)
 
+    try:
+        limit = parseSize(server.mem_limit)
+        if limit < MIN_MEM_LIMIT:
+            raise ValueError("size must be at least " + str(MIN_MEM_LIMIT) + " bytes: " + str(server.mem_limit))
+        server.governor.limit = limit
+    except ValueError, e:
+        print >> sys.stderr, "ERROR: " + str(e) + " for mem_limit\n"
+        server.parser.print_help()
+        sys.exit(1)
+
     # always log to syslog
     if sys.platform == 'darwin':
         log_syslog = logging.handlers.SysLogHandler(address = '/var/run/syslog')
@@ -0,0 +1,270 @@
+#!/usr/bin/python
+
+import unittest
+import errno
+import time
+import os, sys
+import shutil
+
+scriptdir = os.path.realpath(os.path.dirname(__file__))
+sys.path.insert(0, os.path.join(scriptdir, '..'))
+from pyarrfs import pyarrfs
+
+
+
+class GovernorCheck(unittest.TestCase):
+
+	def setUp(self):
+		self.evicted = []
+		self.governor = pyarrfs.MemoryGovernor(100)
+
+	def charge(self, key, size):
+		self.governor.charge(key, size, lambda: self.evicted.append(key))
+
+
+	def test_lru_order(self):
+		"""Least recently used entries are evicted first
+		"""
+		for key in 'abc':
+			self.charge(key, 40)
+		self.assertEqual(self.evicted, ['a'])
+		self.assertEqual(self.governor.usage, 80)
+		self.assertEqual(self.governor.evictions, 1)
+
+
+	def test_touch(self):
+		"""Touching an entry makes it the most recently used
+		"""
+		self.charge('a', 40)
+		self.charge('b', 40)
+		self.governor.touch('a')
+		self.charge('c', 40)
+		self.assertEqual(self.evicted, ['b'])
+
+
+	def test_recharge(self):
+		"""Charging an existing key replaces its size
+		"""
+		self.charge('a', 40)
+		self.charge('a', 60)
+		self.assertEqual(self.governor.usage, 60)
+		self.assertEqual(self.governor.stats()['entries'], 1)
+
+
+	def test_release(self):
+		"""Released entries are forgotten without calling their callback
+		"""
+		self.charge('a', 40)
+		self.charge('b', 40)
+		self.governor.release('a')
+		self.governor.release('x')
+		self.assertEqual(self.governor.usage, 40)
+		self.charge('c', 40)
+		self.assertEqual(self.evicted, [])
+
+
+	def test_keep(self):
+		"""The entry just charged is never evicted, even if over the limit
+		"""
+		self.charge('a', 40)
+		self.charge('b', 200)
+		self.assertEqual(self.evicted, ['a'])
+		self.assertEqual(self.governor.usage, 200)
+
+
+	def test_pinned(self):
+		"""Entries without callback are never evicted, idle ones go first
+		"""
+		self.governor.charge('open', 60)
+		self.charge('a', 30)
+		self.charge('b', 30)
+		self.assertEqual(self.evicted, ['a'])
+		stats = self.governor.stats()
+		self.assertEqual(stats['usage'], 90)
+		self.assertEqual(stats['pinned'], 60)
+		self.assertEqual(stats['evictions'], 1)
+
+
+	def test_unlimited(self):
+		"""Without a limit we only do accounting
+		"""
+		self.governor.limit = None
+		for key in 'abc':
+			self.charge(key, 1000)
+		self.assertEqual(self.evicted, [])
+		self.assertEqual(self.governor.stats()['usage'], 3000)
+		self.assertEqual(self.governor.stats()['limit'], 0)
+
+
+
+class ParseSizeCheck(unittest.TestCase):
+
+	def test_suffixes(self):
+		self.assertEqual(pyarrfs.parseSize('1024'), 1024)
+		self.assertEqual(pyarrfs.parseSize('64k'), 64 * 1024)
+		self.assertEqual(pyarrfs.parseSize('512M'), 512 * 1024 ** 2)
+		self.assertEqual(pyarrfs.parseSize('2G'), 2 * 1024 ** 3)
+		self.assertEqual(pyarrfs.parseSize('1tb'), 1024 ** 4)
+		self.assertEqual(pyarrfs.parseSize(' 8 MB '), 8 * 1024 ** 2)
+
+
+	def test_bad_input(self):
+		for size in [ '', 'M', '-1M', '1.5G', '12X', '1 2' ]:
+			self.assertRaises(ValueError, pyarrfs.parseSize, size)
+
+
+
+class StatsXattrCheck(unittest.TestCase):
+
+	def setUp(self):
+		self.cwd = os.getcwd()
+		self.server = pyarrfs.Pyarr()
+		self.server.governor.charge('a', 42, lambda: None)
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+
+
+	def test_getxattr(self):
+		self.assertEqual(self.server.getxattr('/', 'user.pyarrfs.usage', 100), '42')
+		self.assertEqual(self.server.getxattr('/', 'user.pyarrfs.usage', 0), 2)
+		self.assertEqual(self.server.getxattr('/', 'user.pyarrfs.evictions', 100), '0')
+		self.assertEqual(self.server.getxattr('/', 'user.pyarrfs.limit', 100), str(pyarrfs.parseSize(pyarrfs.DEFAULT_MEM_LIMIT)))
+
+
+	def test_getxattr_unknown(self):
+		self.assertEqual(self.server.getxattr('/', 'user.pyarrfs.foo', 100), -errno.ENODATA)
+
+
+	def test_getxattr_not_root(self):
+		"""The statistics names are reserved and only exist on the root
+		"""
+		self.assertEqual(self.server.getxattr('/tmp', 'user.pyarrfs.usage', 100), -errno.ENODATA)
+
+
+	def test_listxattr(self):
+		os.chdir('/')
+		names = self.server.listxattr('/', 100)
+		for key in self.server.governor.stats():
+			self.assertTrue('user.pyarrfs.' + key in names)
+		self.assertEqual(self.server.listxattr('/', 0), len("".join(names)) + len(names))
+
+
+
+class RarIndexCheck(unittest.TestCase):
+
+	def setUp(self):
+		if os.system('which rar > /dev/null') != 0:
+			self.skipTest("You do not have the 'rar' binary")
+
+		self.cwd = os.getcwd()
+		self.testdir = os.path.join(scriptdir, 'governortest')
+		if not os.path.exists(self.testdir):
+			os.mkdir(self.testdir)
+		self.archive = os.path.join(self.testdir, 'testarchive.rar')
+		if os.path.exists(self.archive):
+			os.unlink(self.archive)
+
+		self.add_file('test1', 'this is testfile1 bla bla bla\n')
+		self.add_file('test2', 'crap crap crap crap\n')
+
+		# all paths are relative to the root, like when mounted
+		os.chdir('/')
+		self.server = pyarrfs.Pyarr()
+
+
+	def tearDown(self):
+		os.chdir(self.cwd)
+		shutil.rmtree(self.testdir)
+
+
+	def add_file(self, filename, content):
+		filepath = os.path.join(self.testdir, filename)
+		f = open(filepath, 'w')
+		f.write(content)
+		f.close()
+		os.system('rar a -inul -ep -m0 ' + self.archive + ' ' + filepath)
+
+
+	def test_valid(self):
+		"""The index is valid until the archive changes
+		"""
+		rf = pyarrfs.rarfile.RarFile(self.archive)
+		ri = pyarrfs.RarIndex(rf.infolist(), os.stat(self.archive))
+		self.assertEqual(sorted(ri.names), ['test1', 'test2'])
+		self.assertEqual(ri.members['test2'].file_size, 20)
+		self.assertTrue(ri.valid(os.stat(self.archive)))
+
+		# make sure mtime changes
+		time.sleep(1)
+		self.add_file('test3', 'more crap\n')
+		self.assertFalse(ri.valid(os.stat(self.archive)))
+
+
+	def test_revalidate(self):
+		"""The cached index is reused, and rebuilt when the archive changes
+		"""
+		ri = self.server.rarIndex(self.archive)
+		self.assertTrue(self.server.rarIndex(self.archive) is ri)
+
+		time.sleep(1)
+		self.add_file('test3', 'more crap\n')
+		ri2 = self.server.rarIndex(self.archive)
+		self.assertFalse(ri2 is ri)
+		self.assertTrue('test3' in ri2.members)
+		self.assertEqual(self.server.governor.usage, ri2.nbytes)
+
+
+	def test_get_member(self):
+		"""Members are found with either path separator, like getinfo()
+		"""
+		rf = pyarrfs.rarfile.RarFile(self.archive)
+		ri = pyarrfs.RarIndex(rf.infolist(), os.stat(self.archive))
+		ri.members['dir' + pyarrfs.rarfile.PATH_SEP + 'test4'] = ri.members['test1']
+		self.assertTrue(ri.getMember('dir/test4') is ri.members['test1'])
+		self.assertTrue(ri.getMember('dir\\test4') is ri.members['test1'])
+		self.assertTrue(ri.getMember('nope') is None)
+
+
+	def test_index_from_shared_rarfile(self):
+		"""The index is built from the RarFile of open files in the archive
+		"""
+		srf = self.server.openRarFile(self.archive)
+		rarfile = pyarrfs.rarfile.RarFile
+		try:
+			pyarrfs.rarfile.RarFile = None
+			ri = self.server.rarIndex(self.archive)
+		finally:
+			pyarrfs.rarfile.RarFile = rarfile
+		self.assertEqual(sorted(ri.names), ['test1', 'test2'])
+		self.server.closeRarFile(self.archive, srf)
+
+
+	def test_deleted(self):
+		"""The index of a deleted archive is dropped
+		"""
+		self.server.rarIndex(self.archive)
+		os.unlink(self.archive)
+		self.assertRaises(OSError, self.server.rarIndex, self.archive)
+		self.assertFalse(self.archive in self.server.archives)
+		self.assertEqual(self.server.governor.usage, 0)
+
+
+	def test_shared_rarfile(self):
+		"""Files open within the same archive share one RarFile
+		"""
+		srf = self.server.openRarFile(self.archive)
+		self.assertTrue(self.server.openRarFile(self.archive) is srf)
+		self.assertEqual(srf.refs, 2)
+		usage = self.server.governor.usage
+		self.assertEqual(usage, srf.nbytes())
+
+		self.server.closeRarFile(self.archive, srf)
+		self.assertEqual(self.server.governor.usage, usage)
+		self.server.closeRarFile(self.archive, srf)
+		self.assertFalse(self.archive in self.server.rarfiles)
+		self.assertEqual(self.server.governor.usage, 0)
+
+
+if __name__ == '__main__':
+	unittest.main()